@@ -3,20 +3,189 @@ title: Adobe Firefly Integration
 author: Graham Hutchinson
 author_url: https://github.com/ghhutch
 version: 0.2
+requirements: httpx[http2], orjson
 """
 
+import asyncio
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import tempfile
 import time
-import requests
+import uuid
+import weakref
+import httpx
 import logging
+from pathlib import Path
+from urllib.parse import quote_plus
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, List
+from typing import Optional, Any
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+# Open WebUI configures the root logger; messages use lazy %-formatting
 logger = logging.getLogger("firefly_integration")
 
+# orjson is optional; the stdlib fallbacks produce and accept the same bytes
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    _json_loads = json.loads
+
+
+# Adobe IMS and Firefly endpoints, with the headers that never change per call
+_IMS_URL = "https://ims-na1.adobelogin.com/ims/token/v3"
+_IMS_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+_FIREFLY_URL = "https://firefly-api.adobe.io/v3/images/generate"
+_FIREFLY_ASYNC_URL = "https://firefly-api.adobe.io/v3/images/generate-async"
+_FIREFLY_HEADERS_BASE = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}
+
+# Client-credentials form body; only the credentials vary between calls
+_IMS_BODY_TMPL = (
+    "grant_type=client_credentials&client_id={cid}&client_secret={csec}"
+    "&scope=openid%2CAdobeID%2Csession%2Cadditional_info%2Cread_organizations"
+    "%2Cfirefly_api%2Cff_apis"
+)
+
+# HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Transient responses retried by Filter._request, with exponential backoff
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_RETRY_TOTAL = 3
+_RETRY_BACKOFF = 0.3
+
+# Each line starting with /firefly adds another prompt to the request
+_COMMAND_RE = re.compile(r"^/firefly(?=\s|$)", re.IGNORECASE | re.MULTILINE)
+
+# Async job polling: seconds between status checks (last value repeats),
+# overall deadline per job, and how many jobs a batch runs at once
+_POLL_DELAYS = (1, 2, 5)
+_POLL_TIMEOUT = 300
+_MAX_CONCURRENT_JOBS = 8
+
+# Identical prompts share one Firefly call; results are reused this long
+_RESULT_TTL = 600
+
+# Per-request state left behind by turns that never reached outlet is
+# discarded after this many seconds
+_CONTEXT_TTL = 3600
+
+# Refresh cached tokens this many seconds before they expire
+_TOKEN_REFRESH_MARGIN = 600
+
+try:
+    from open_webui.config import CACHE_DIR, DATA_DIR
+except ImportError:  # running outside Open WebUI
+    DATA_DIR = os.environ.get("DATA_DIR", "data")
+    CACHE_DIR = Path(DATA_DIR) / "cache"
+
+# Persisted token cache, kept out of the publicly served cache directory
+TOKEN_CACHE_PATH = Path(DATA_DIR) / ".firefly_token_cache.json"
+
+# Downloaded images, served by Open WebUI under /cache/
+IMAGES_DIR = Path(CACHE_DIR) / "image" / "generations"
+IMAGES_URL_PREFIX = "/cache/image/generations"
+
+# Only raster images are saved; anything else (HTML, SVG) would be served
+# from Open WebUI's own origin
+_IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+}
+
+
+class FireflyAPIError(Exception):
+    """Raised when Adobe IMS or Firefly rejects a request or returns no image"""
+
+
+_TOKEN_ERROR_MSG = "Failed to obtain access token from Adobe API. Please verify your client_id and client_secret are valid and have the correct permissions."
+
+
+def _parse_firefly_error(response):
+    """Log a failed IMS or Firefly response and return its most useful error message"""
+    logger.error("Response status code: %d", response.status_code)
+    logger.error("Response content: %s", response.text)
+    try:
+        error_content = _json_loads(response.content)
+    except ValueError:
+        error_content = None
+
+    if isinstance(error_content, dict):
+        error = error_content.get("error")
+        if isinstance(error, dict) and error.get("message"):
+            return error["message"]
+        if error_content.get("message"):
+            return error_content["message"]
+        # IMS reports {"error": "<code>", "error_description": "<text>"}
+        if isinstance(error, str) and error:
+            return error_content.get("error_description") or error
+    return f"{response.status_code} {response.reason_phrase}"
+
+
+def _decode_firefly_json(response):
+    """Decode a successful Firefly response, raising FireflyAPIError if it isn't a JSON object"""
+    try:
+        data = _json_loads(response.content)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        logger.error("Response content: %s", response.text)
+        raise FireflyAPIError(
+            f"Adobe Firefly API returned an unreadable response (status {response.status_code})"
+        )
+    return data
+
+
+def _request_key(metadata):
+    """Identify a chat turn so inlet, stream and outlet share its state
+
+    Returns None unless both ids are present: API calls made without a chat
+    share (None, None) and never reach outlet, so they can't be tracked.
+    """
+    if not metadata:
+        return None
+    chat_id = metadata.get("chat_id")
+    message_id = metadata.get("message_id")
+    if not chat_id or not message_id:
+        return None
+    return (chat_id, message_id)
+
+
+async def _refresh_token_later(filter_ref, delay):
+    """Re-fetch a filter's default token after delay so inlet finds it warm
+
+    The filter is held only weakly, so an instance replaced by a function
+    reload is collected instead of being kept alive refreshing forever.
+    """
+    await asyncio.sleep(delay)
+    filter_ = filter_ref()
+    if filter_ is not None:
+        await filter_._refresh_token()
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_size(size):
+    """Parse a size string such as "1024x1024" into (width, height)"""
+    try:
+        width, height = map(int, size.split("x"))
+    except ValueError:
+        raise ValueError(f"Invalid size format: {size}. Use format '1024x1024'")
+    return width, height
+
+
 class Filter:
 
     class Valves(BaseModel):
@@ -52,29 +221,36 @@ class Filter:
         self.type = "filter"
         self.id = "firefly_filter"
         self.name = "Firefly Filter"
-        self.token_cache = {"access_token": None, "expires_at": 0}
-        self.image_html = ""
-        self.image_url = ""
-        self.prompt = ""
-        self.apply_filter = False
+        self.token_cache = {"access_token": None, "expires_at": 0, "client_id": None}
+        # State for in-progress /firefly requests, keyed by _request_key
+        self._contexts = {}
         self.valves = self.Valves()
 
+        # Shared async client so concurrent IMS and Firefly calls multiplex
+        # over pooled (HTTP/2 when available) connections
+        self._aclient = httpx.AsyncClient(
+            timeout=60,
+            transport=httpx.AsyncHTTPTransport(
+                http2=_HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                retries=_RETRY_TOTAL,
+            ),
+        )
+        self._refresh_task = None
+        self._token_lock = asyncio.Lock()
+        self._headers_key = None
+        self._headers_template = {}
+        self._inflight = {}
+        self._load_token_cache()
+
         # Log configuration status at initialization
         if self.valves.client_id and self.valves.client_secret:
             logger.info(
-                f"Adobe Firefly integration initialized with client_id: {self.valves.client_id[:5]}..."
+                "Adobe Firefly integration initialized with client_id: %s...",
+                self.valves.client_id[:5],
             )
-
-            # Try to get an initial token to verify credentials
-            try:
-                if self._get_valid_token():
-                    logger.info("Successfully verified Adobe Firefly API credentials")
-                else:
-                    logger.warning(
-                        "Could not verify Adobe Firefly API credentials - token request failed"
-                    )
-            except Exception as e:
-                logger.warning(f"Could not verify Adobe Firefly API credentials: {e}")
+            # Credentials are verified lazily: the first /firefly command
+            # fetches a token via _get_valid_token, keeping plugin load offline
         else:
             logger.warning(
                 "Adobe Firefly integration initialized but missing API credentials"
@@ -83,9 +259,14 @@ class Filter:
                 "Set FIREFLY_CLIENT_ID and FIREFLY_CLIENT_SECRET environment variables or configure in valves"
             )
 
-    def inlet(self, body: dict, __user__: Optional[Any] = None) -> dict:
+    async def inlet(
+        self,
+        body: dict,
+        __user__: Optional[Any] = None,
+        __metadata__: Optional[dict] = None,
+    ) -> dict:
         """Process incoming requests before they reach the API"""
-        logger.info(f"inlet:{__name__}")
+        logger.info("inlet:%s", __name__)
 
         # Check if this is a request for image generation
         messages = body.get("messages", [])
@@ -94,20 +275,24 @@ class Filter:
             content = last_message.get("content", "")
 
             # Check if the message contains a command to generate an image
-            if isinstance(content, str) and content.lower().startswith("/firefly"):
+            # Only the command prefix is lowercased, not the whole message
+            if (
+                isinstance(content, str)
+                and len(content) >= 8
+                and content[:8].lower() == "/firefly"
+                and (len(content) == 8 or content[8] in " \t\r\n")
+            ):
 
-                # Set apply filter for subsequent actions in the filter
-                logger.info(f"Prompt contains /firefly - apply filter")
-                self.apply_filter = True
+                # Extract prompts from the command
+                prompts = [p.strip() for p in _COMMAND_RE.split(content)]
+                prompts = [p for p in prompts if p]
 
-                # Extract prompt from the command
-                prompt = content[len("/firefly") :].strip()
-                self.prompt = prompt
+                logger.info("Prompt contains /firefly - apply filter")
 
                 # Check if a prompt was provided
-                if not prompt:
+                if not prompts:
                     # If no prompt is provided, we'll respond with usage instructions
-                    body["messages"][-1][
+                    last_message[
                         "content"
                     ] = "Please provide a prompt for image generation. Usage: /firefly your prompt here"
                     return body
@@ -121,70 +306,148 @@ class Filter:
                 # Get user-specific credentials if available
                 user_valves = getattr(__user__, "valves", None)
 
+                valves = self.valves
+                cid = valves.client_id
+                csecret = valves.client_secret
+
                 # Debug credential info
-                logger.debug(
-                    f"Using client_id: {self.valves.client_id[:5]}... (length: {len(self.valves.client_id)})"
-                )
-                logger.debug(
-                    f"Using client_secret: {self.valves.client_secret[:3]}... (length: {len(self.valves.client_secret)})"
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Using client_id: %s... (length: %d)", cid[:5], len(cid))
+                    logger.debug(
+                        "Using client_secret: %s... (length: %d)",
+                        csecret[:3],
+                        len(csecret),
+                    )
 
-                if not self.valves.client_id or len(self.valves.client_id) < 10:
+                if not cid or len(cid) < 10:
                     error_msg = "Adobe Firefly client_id is missing or invalid. Please set FIREFLY_CLIENT_ID environment variable or configure in valves."
                     logger.error(error_msg)
-                    body["messages"][-1]["content"] = error_msg
-                    self.apply_filter = False
+                    last_message["content"] = error_msg
                     return body
 
-                if not self.valves.client_secret or len(self.valves.client_secret) < 10:
+                if not csecret or len(csecret) < 10:
                     error_msg = "Adobe Firefly client_secret is missing or invalid. Please set FIREFLY_CLIENT_SECRET environment variable or configure in valves."
                     logger.error(error_msg)
-                    body["messages"][-1]["content"] = error_msg
-                    self.apply_filter = False
+                    last_message["content"] = error_msg
                     return body
 
-                # Generate the image
-                try:
-                    result = self._generate_image(
-                        prompt,
-                        client_id=self.valves.client_id,
-                        client_secret=self.valves.client_secret,
-                        size=self.valves.default_size,
-                        content_class=self.valves.default_content_class,
+                # Apply the filter to this request's stream and outlet only. Without
+                # chat/message ids the outlet can't be matched to this request, so
+                # skip the (billed) generation rather than discard its image.
+                key = _request_key(__metadata__)
+                if key is None:
+                    logger.warning(
+                        "Skipping /firefly generation: request has no chat_id/message_id"
                     )
+                    return body
+                ctx = {"image_urls": [], "created": time.time()}
+                self._prune_contexts()
+                self._contexts[key] = ctx
+
+                # Generate the image(s); several prompts run as one batch of jobs
+                try:
+                    generate_kwargs = {
+                        "client_id": cid,
+                        "client_secret": csecret,
+                        "size": valves.default_size,
+                        "content_class": valves.default_content_class,
+                    }
+                    if len(prompts) == 1:
+                        ctx["image_urls"] = [
+                            await self._generate_image(prompts[0], **generate_kwargs)
+                        ]
+                    else:
+                        ctx["image_urls"] = await self._generate_images_batch(
+                            prompts, **generate_kwargs
+                        )
 
                     # Replace the user message with the result
-                    body["messages"][-1]["content"] = ""
+                    last_message["content"] = ""
 
                 except Exception as e:
-                    logger.error(f"Error generating image: {e}")
-                    body["messages"][-1][
+                    logger.error("Error generating image: %s", e)
+                    # Let the model's reply to the error text reach the user
+                    self._contexts.pop(key, None)
+                    last_message[
                         "content"
                     ] = f"Error generating image: {str(e)}\n\nPlease check that your Adobe Firefly API credentials are valid and have sufficient permissions."
 
         return body
 
-    def stream(self, event: dict) -> dict:
-        if self.apply_filter:
-            for choice in event.get("choices", []):
-                delta = choice.get("delta", {})
-                if "content" in delta:
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
+        # Fast path for every token of every chat that isn't a /firefly request
+        if not self._contexts:
+            return event
+        key = _request_key(__metadata__)
+        ctx = self._contexts.get(key)
+        if ctx is None:
+            return event
+        if ctx["created"] < time.time() - _CONTEXT_TTL:
+            del self._contexts[key]
+            return event
+
+        choices = event.get("choices")
+        if choices:
+            for choice in choices:
+                delta = choice.get("delta")
+                if delta and "content" in delta:
                     # don't output stream to ui.
                     delta["content"] = ""
         return event
 
-    def outlet(self, body: dict, __user__: Optional[Any] = None) -> dict:
+    def outlet(
+        self,
+        body: dict,
+        __user__: Optional[Any] = None,
+        __metadata__: Optional[dict] = None,
+    ) -> dict:
         """Process outgoing responses after they come from the API"""
-        if self.apply_filter:
-            logger.debug(f"outlet:{__name__}")
-            logger.info(f"image_url: {self.image_url}")
+        if not self._contexts:
+            return body
 
-            body["messages"][-1]["content"] = f"![image]({self.image_url})\n"
+        # The completed-chat body carries the same ids as the inlet metadata
+        key = _request_key(
+            __metadata__
+            or {"chat_id": body.get("chat_id"), "message_id": body.get("id")}
+        )
+        ctx = self._contexts.pop(key, None) if key is not None else None
+
+        if (
+            ctx
+            and ctx["image_urls"]
+            and ctx["created"] >= time.time() - _CONTEXT_TTL
+        ):
+            logger.debug("outlet:%s", __name__)
+            logger.info("image_urls: %s", ctx["image_urls"])
+
+            body["messages"][-1]["content"] = "".join(
+                f"![image]({image_url})\n" for image_url in ctx["image_urls"]
+            )
 
-        self.apply_filter = False
         return body
 
-    def _get_access_token(self, client_id=None, client_secret=None):
+    def _prune_contexts(self):
+        """Forget requests whose outlet never ran (e.g. a stopped generation)"""
+        cutoff = time.time() - _CONTEXT_TTL
+        for key, ctx in list(self._contexts.items()):
+            if ctx["created"] < cutoff:
+                del self._contexts[key]
+
+    async def _request(self, method, url, **kwargs):
+        """Send through the shared client, retrying transient status codes"""
+        for attempt in range(_RETRY_TOTAL + 1):
+            response = await self._aclient.request(method, url, **kwargs)
+            if response.status_code not in _RETRY_STATUSES or attempt == _RETRY_TOTAL:
+                return response
+            logger.warning(
+                "Retrying %s after status %d (attempt %d)",
+                url,
+                response.status_code,
+                attempt + 1,
+            )
+            await asyncio.sleep(_RETRY_BACKOFF * (2**attempt))
+
+    async def _get_access_token(self, client_id=None, client_secret=None):
         """
         Get an access token from Adobe IMS using client credentials
 
@@ -207,53 +470,77 @@ class Filter:
             )
             return None
 
-        logger.info(f"Requesting access token for client_id: {client_id[:5]}...")
+        logger.info("Requesting access token for client_id: %s...", client_id[:5])
 
-        url = "https://ims-na1.adobelogin.com/ims/token/v3"
+        payload = _IMS_BODY_TMPL.format(
+            cid=quote_plus(client_id), csec=quote_plus(client_secret)
+        ).encode()
 
-        payload = {
-            "grant_type": "client_credentials",
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "scope": "openid,AdobeID,session,additional_info,read_organizations,firefly_api,ff_apis",
-        }
+        try:
+            response = await self._request(
+                "POST", _IMS_URL, headers=_IMS_HEADERS, content=payload
+            )
+        except httpx.HTTPError as e:
+            logger.error("Error obtaining access token: %s", e)
+            return None
 
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if response.status_code >= 400:
+            logger.error(
+                "Error obtaining access token: %s", _parse_firefly_error(response)
+            )
+            return None
 
         try:
-            response = requests.post(url, headers=headers, data=payload)
-            response.raise_for_status()
-            token_data = response.json()
-            logger.info("Successfully obtained access token")
-            return token_data
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error obtaining access token: {e}")
-            if hasattr(e, "response") and e.response is not None:
-                logger.error(f"Response status code: {e.response.status_code}")
-                logger.error(f"Response content: {e.response.text}")
+            token_data = _json_loads(response.content)
+        except ValueError as e:
+            logger.error("Error decoding access token response: %s", e)
+            logger.error("Response content: %s", response.text)
             return None
+        logger.info("Successfully obtained access token")
+        return token_data
 
-    def _get_valid_token(self, client_id=None, client_secret=None):
+    async def _get_valid_token(self, client_id=None, client_secret=None):
         """Get a valid access token, refreshing if needed"""
         # If using default credentials, check cache first
         if (client_id is None or client_id == self.valves.client_id) and (
             client_secret is None or client_secret == self.valves.client_secret
         ):
+            access_token = self._cached_token()
+            if access_token:
+                # A token restored from disk has no refresh scheduled yet
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._schedule_token_refresh(
+                        self.token_cache["expires_at"] - time.time()
+                    )
+                return access_token
+
+            # Only one request fetches a new token; concurrent ones wait and reuse it
+            async with self._token_lock:
+                access_token = self._cached_token()
+                if access_token:
+                    return access_token
+                return await self._request_token(client_id, client_secret)
+
+        return await self._request_token(client_id, client_secret)
+
+    def _cached_token(self):
+        """Return the cached token unless it is missing or about to expire"""
+        token_cache = self.token_cache
+        # Check if token needs refresh (expired or will expire in 5 minutes)
+        if (
+            token_cache["access_token"] is not None
+            and token_cache["client_id"] == self.valves.client_id
+            and token_cache["expires_at"] > time.time() + 300
+        ):
+            return token_cache["access_token"]
+        return None
 
-            current_time = time.time()
-
-            # Check if token needs refresh (expired or will expire in 5 minutes)
-            if (
-                self.token_cache["access_token"] is not None
-                and self.token_cache["expires_at"] > current_time + 300
-            ):
-                return self.token_cache["access_token"]
-
-        # Get new token
+    async def _request_token(self, client_id=None, client_secret=None):
+        """Fetch a new token from IMS, caching it for the default credentials"""
         client_id = client_id or self.valves.client_id
         client_secret = client_secret or self.valves.client_secret
 
-        token_response = self._get_access_token(client_id, client_secret)
+        token_response = await self._get_access_token(client_id, client_secret)
 
         if token_response and "access_token" in token_response:
             # Cache the token if using default credentials
@@ -261,17 +548,151 @@ class Filter:
                 client_id == self.valves.client_id
                 and client_secret == self.valves.client_secret
             ):
-                self.token_cache["access_token"] = token_response["access_token"]
-                self.token_cache["expires_at"] = time.time() + token_response.get(
-                    "expires_in", 86400
-                )
+                self._cache_token(token_response)
 
             return token_response["access_token"]
         else:
             return None
 
+    def _cache_token(self, token_response):
+        """Store a default-credential token and schedule its proactive refresh"""
+        expires_in = token_response.get("expires_in", 86400)
+        # Swap in a new dict so readers never see a half-updated cache
+        self.token_cache = {
+            "access_token": token_response["access_token"],
+            "expires_at": time.time() + expires_in,
+            "client_id": self.valves.client_id,
+        }
+        self._save_token_cache()
+        self._schedule_token_refresh(expires_in)
+
+    def _load_token_cache(self):
+        """Restore a persisted token; returns True if it is still valid"""
+        try:
+            with TOKEN_CACHE_PATH.open() as f:
+                token_cache = json.load(f)
+            os.chmod(TOKEN_CACHE_PATH, 0o600)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning("Could not load Adobe Firefly token cache: %s", e)
+            return False
+
+        if not (
+            isinstance(token_cache, dict)
+            and isinstance(token_cache.get("access_token"), str)
+            and isinstance(token_cache.get("expires_at"), (int, float))
+            and token_cache["expires_at"] > time.time() + 300
+        ):
+            return False
+
+        self.token_cache = {
+            "access_token": token_cache["access_token"],
+            "expires_at": token_cache["expires_at"],
+            "client_id": token_cache.get("client_id"),
+        }
+        # The proactive refresh starts with the first request that uses it
+        logger.info("Restored Adobe Firefly access token from disk")
+        return True
 
-    def _generate_image(
+    def _save_token_cache(self):
+        """Persist the default-credential token so restarts can reuse it"""
+        tmp_path = None
+        try:
+            TOKEN_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            # A unique 0600 temp file per writer, so concurrent workers never
+            # truncate each other's half-written cache
+            fd, tmp_path = tempfile.mkstemp(
+                dir=TOKEN_CACHE_PATH.parent, prefix=".firefly_token_cache."
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.token_cache, f)
+            os.replace(tmp_path, TOKEN_CACHE_PATH)
+        except OSError as e:
+            logger.warning("Could not persist Adobe Firefly token cache: %s", e)
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    def _schedule_token_refresh(self, expires_in):
+        """Replace any pending refresh with one that fires before expiry"""
+        if (
+            self._refresh_task is not None
+            and self._refresh_task is not asyncio.current_task()
+        ):
+            self._refresh_task.cancel()
+        delay = max(expires_in - _TOKEN_REFRESH_MARGIN, 60)
+        try:
+            self._refresh_task = asyncio.get_running_loop().create_task(
+                _refresh_token_later(weakref.ref(self), delay)
+            )
+        except RuntimeError:
+            self._refresh_task = None
+
+    async def _refresh_token(self):
+        """Re-fetch the default token, keeping the current one on failure"""
+        logger.info("Proactively refreshing Adobe Firefly access token")
+        token_response = await self._get_access_token(
+            self.valves.client_id, self.valves.client_secret
+        )
+        if token_response and "access_token" in token_response:
+            self._cache_token(token_response)
+        else:
+            # Leave the current token in place; _get_valid_token refreshes on demand
+            logger.warning("Proactive token refresh failed")
+
+    async def on_shutdown(self):
+        """Cancel the background token refresh and close the HTTP client"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        await self._aclient.aclose()
+
+    def _firefly_headers(self, client_id, access_token):
+        """Build Firefly request headers from a template rebuilt on valve changes"""
+        model = self.valves.default_model
+        if self._headers_key != (client_id, model):
+            self._headers_template = {
+                **_FIREFLY_HEADERS_BASE,
+                "x-api-key": client_id,
+                "x-model-version": model,
+            }
+            self._headers_key = (client_id, model)
+        return {**self._headers_template, "Authorization": f"Bearer {access_token}"}
+
+    def _prompt_key(self, prompt, client_id, size, content_class):
+        """Key identifying generations that would produce the same request"""
+        raw = "\0".join(
+            (prompt, size, content_class, self.valves.default_model, client_id)
+        )
+        return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+    async def _coalesced(self, key, factory):
+        """Await a shared task per key, starting it with factory() if needed"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._expire_inflight, key))
+        # Shield so one cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+    def _expire_inflight(self, key, task):
+        """Drop failed calls now and successful ones after _RESULT_TTL"""
+        if task.cancelled() or task.exception() is not None:
+            self._drop_inflight(key, task)
+        else:
+            asyncio.get_running_loop().call_later(
+                _RESULT_TTL, self._drop_inflight, key, task
+            )
+
+    def _drop_inflight(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _generate_image(
         self,
         prompt,
         client_id=None,
@@ -280,7 +701,7 @@ class Filter:
         content_class="photo",
     ):
         """
-        Generate an image using Adobe Firefly API and return formatted content
+        Generate an image using Adobe Firefly API and return where it is served
 
         Args:
             prompt (str): Text prompt describing the image to generate
@@ -290,96 +711,250 @@ class Filter:
             content_class (str): Type of content to generate (photo, art)
 
         Returns:
-            str: HTML content with embedded image if successful
+            str: Local /cache/image/generations/ URL of the saved image, or the
+            remote Firefly URL if saving it failed
         """
+        key = self._prompt_key(
+            prompt, client_id or self.valves.client_id, size, content_class
+        )
+        return await self._coalesced(
+            key,
+            functools.partial(
+                self._request_image,
+                prompt,
+                client_id,
+                client_secret,
+                size,
+                content_class,
+            ),
+        )
+
+    async def _request_image(
+        self, prompt, client_id, client_secret, size, content_class
+    ):
+        """Call the synchronous Firefly generate endpoint for one prompt"""
         # Get access token
-        access_token = self._get_valid_token(client_id, client_secret)
+        access_token = await self._get_valid_token(client_id, client_secret)
         if not access_token:
-            raise Exception(
-                "Failed to obtain access token from Adobe API. Please verify your client_id and client_secret are valid and have the correct permissions."
-            )
+            raise FireflyAPIError(_TOKEN_ERROR_MSG)
 
         # Use provided credentials or default ones
         client_id = client_id or self.valves.client_id
 
-        # Adobe Firefly API endpoint
-        url = "https://firefly-api.adobe.io/v3/images/generate"
-
         # Parse dimensions
-        try:
-            width, height = map(int, size.split("x"))
-        except ValueError:
-            raise ValueError(f"Invalid size format: {size}. Use format '1024x1024'")
+        width, height = _parse_size(size)
 
         # Request headers
-        headers = {
-            "x-api-key": client_id,
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "x-model-version": self.valves.default_model,
-        }
-
-        # Request payload
-        payload = {
-            "prompt": prompt,
-            "size": {"width": width, "height": height},
-            "contentClass": content_class,
-        }
+        headers = self._firefly_headers(client_id, access_token)
+
+        # Request payload, serialized up front so it is sent with a Content-Length
+        payload = _json_dumps(
+            {
+                "prompt": prompt,
+                "size": {"width": width, "height": height},
+                "contentClass": content_class,
+            }
+        )
 
+        # Make the API request
+        logger.info("Sending request to Firefly API with prompt: '%s'", prompt)
         try:
-            # Make the API request
-            logger.info(f"Sending request to Firefly API with prompt: '{prompt}'")
-            response = requests.post(url, headers=headers, json=payload)
-            response.raise_for_status()
+            response = await self._request(
+                "POST", _FIREFLY_URL, headers=headers, content=payload
+            )
+        except httpx.HTTPError as e:
+            logger.error("Error making request to Adobe Firefly API: %s", e)
+            raise
 
-            # Parse the response
-            data = response.json()
+        if response.status_code >= 400:
+            raise FireflyAPIError(
+                f"Adobe Firefly API error: {_parse_firefly_error(response)}"
+            )
 
-            # Extract the image URL from the response
-            if (
-                "outputs" in data
-                and len(data["outputs"]) > 0
-                and "image" in data["outputs"][0]
-            ):
-                image_url = data["outputs"][0]["image"]["url"]
-                self.image_url = image_url
-                logger.info(f"Image URL received: {image_url}")
-
-                # return html_content
-                return image_url
-            else:
-                logger.error("No image URL found in response")
-                logger.error(f"Response: {data}")
-
-                # Check if there's an error message in the response
-                error_msg = "No image URL found in Firefly API response"
-                if "error" in data:
-                    error_msg += f": {data['error'].get('message', '')}"
-                elif "errors" in data and data["errors"]:
-                    error_msg += f": {data['errors'][0].get('message', '')}"
-
-                raise Exception(error_msg)
-
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error making request to Adobe Firefly API: {e}")
-            if hasattr(e, "response") and e.response is not None:
-                logger.error(f"Response status code: {e.response.status_code}")
-                logger.error(f"Response content: {e.response.text}")
-
-                # Try to extract error message from response
-                try:
-                    error_content = e.response.json()
-                    if "error" in error_content:
-                        error_msg = error_content["error"].get("message", str(e))
-                    else:
-                        error_msg = str(e)
-                except:
-                    error_msg = str(e)
+        # Parse the response
+        data = _decode_firefly_json(response)
+
+        # Extract the image URL from the response
+        if (
+            "outputs" in data
+            and len(data["outputs"]) > 0
+            and "image" in data["outputs"][0]
+        ):
+            image_url = data["outputs"][0]["image"]["url"]
+            logger.info("Image URL received: %s", image_url)
+
+            # Save locally and return the served URL (remote URL on failure)
+            return await self._download_image(image_url)
+
+        logger.error("No image URL found in response")
+        logger.error("Response: %s", data)
 
-                raise Exception(f"Adobe Firefly API error: {error_msg}")
+        # Check if there's an error message in the response
+        error_msg = "No image URL found in Firefly API response"
+        if "error" in data:
+            error_msg += f": {data['error'].get('message', '')}"
+        elif "errors" in data and data["errors"]:
+            error_msg += f": {data['errors'][0].get('message', '')}"
+
+        raise FireflyAPIError(error_msg)
+
+    async def _generate_images_batch(
+        self,
+        prompts,
+        client_id=None,
+        client_secret=None,
+        size="1024x1024",
+        content_class="photo",
+    ):
+        """
+        Generate one image per prompt using the Firefly asynchronous job API
+
+        Jobs are submitted and polled concurrently over the shared client, so
+        the batch takes roughly as long as its slowest job.
+
+        Args:
+            prompts (list): Text prompts, one image each
+            client_id (str, optional): Adobe Firefly client ID
+            client_secret (str, optional): Adobe Firefly client secret
+            size (str): Size of the images to generate (e.g., "1024x1024")
+            content_class (str): Type of content to generate (photo, art)
+
+        Returns:
+            list: Image URLs, in the same order as prompts
+        """
+        # Get access token
+        access_token = await self._get_valid_token(client_id, client_secret)
+        if not access_token:
+            raise FireflyAPIError(_TOKEN_ERROR_MSG)
+
+        # Use provided credentials or default ones
+        client_id = client_id or self.valves.client_id
+
+        width, height = _parse_size(size)
+        headers = self._firefly_headers(client_id, access_token)
+        semaphore = asyncio.Semaphore(_MAX_CONCURRENT_JOBS)
+
+        async def run(prompt):
+            async with semaphore:
+                return await self._run_image_job(
+                    prompt, headers, width, height, content_class
+                )
+
+        tasks = [
+            asyncio.ensure_future(
+                self._coalesced(
+                    self._prompt_key(prompt, client_id, size, content_class),
+                    functools.partial(run, prompt),
+                )
+            )
+            for prompt in prompts
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop waiting on the rest; their jobs finish and stay cached
+            for task in tasks:
+                task.cancel()
             raise
-        except Exception as e:
-            logger.error(f"Error processing image: {e}")
+
+    async def _run_image_job(self, prompt, headers, width, height, content_class):
+        """Submit one asynchronous Firefly job and poll it until it finishes"""
+        payload = _json_dumps(
+            {
+                "prompt": prompt,
+                "size": {"width": width, "height": height},
+                "contentClass": content_class,
+            }
+        )
+
+        logger.info("Submitting Firefly job with prompt: '%s'", prompt)
+        try:
+            response = await self._request(
+                "POST", _FIREFLY_ASYNC_URL, headers=headers, content=payload
+            )
+            if response.status_code >= 400:
+                raise FireflyAPIError(
+                    f"Adobe Firefly API error: {_parse_firefly_error(response)}"
+                )
+            status_url = _decode_firefly_json(response).get("statusUrl")
+            if not status_url:
+                raise FireflyAPIError(
+                    "Adobe Firefly API did not return a status URL for the job"
+                )
+
+            # Poll with backoff until the job succeeds, fails or times out
+            deadline = time.monotonic() + _POLL_TIMEOUT
+            attempt = 0
+            while True:
+                await asyncio.sleep(_POLL_DELAYS[min(attempt, len(_POLL_DELAYS) - 1)])
+                attempt += 1
+
+                response = await self._request("GET", status_url, headers=headers)
+                if response.status_code >= 400:
+                    raise FireflyAPIError(
+                        f"Adobe Firefly API error: {_parse_firefly_error(response)}"
+                    )
+                job = _decode_firefly_json(response)
+                status = job.get("status")
+
+                if status == "succeeded":
+                    outputs = job.get("result", {}).get("outputs") or []
+                    if outputs and "image" in outputs[0]:
+                        image_url = outputs[0]["image"]["url"]
+                        logger.info("Image URL received: %s", image_url)
+                        return await self._download_image(image_url)
+                    logger.error("No image URL found in job result: %s", job)
+                    raise FireflyAPIError("No image URL found in Firefly API response")
+
+                if status in ("failed", "canceled", "cancelled"):
+                    logger.error("Firefly job %s: %s", status, job)
+                    raise FireflyAPIError(
+                        f"Firefly job {status}: {job.get('message') or job.get('error_code', '')}"
+                    )
+
+                if time.monotonic() > deadline:
+                    raise FireflyAPIError(
+                        f"Timed out waiting for Firefly job for prompt: '{prompt}'"
+                    )
+
+        except httpx.HTTPError as e:
+            logger.error("Error making request to Adobe Firefly API: %s", e)
             raise
 
+    async def _download_image(self, image_url):
+        """
+        Stream a generated image into IMAGES_DIR so chats don't re-fetch it
+
+        Args:
+            image_url (str): Presigned Firefly URL of the generated image
+
+        Returns:
+            str: Local URL of the saved image, or image_url if saving failed
+        """
+        path = None
+        try:
+            async with self._aclient.stream("GET", image_url) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "")
+                content_type = content_type.split(";")[0].strip().lower()
+                extension = _IMAGE_EXTENSIONS.get(content_type)
+                if extension is None:
+                    logger.warning(
+                        "Not saving generated image with content type %r, using remote URL",
+                        content_type,
+                    )
+                    return image_url
+
+                IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+                path = IMAGES_DIR / f"{uuid.uuid4()}{extension}"
+                with path.open("wb") as f:
+                    async for chunk in response.aiter_bytes(1 << 20):
+                        f.write(chunk)
+        except (httpx.HTTPError, OSError) as e:
+            logger.warning("Could not save generated image, using remote URL: %s", e)
+            if path is not None:
+                path.unlink(missing_ok=True)
+            return image_url
+
+        logger.info("Saved generated image to %s", path)
+        return f"{IMAGES_URL_PREFIX}/{path.name}"